@@ -1,3 +1,4 @@
-from .create import create_multiset_from_labels, downsample_multiset, merge_multisets
+from .create import (create_multiset_from_labels, downsample_multiset,
+                     merge_multisets, merge_multisets_chunked)
 from .label_multiset import LabelMultiset
 from .serialize import serialize_multiset, deserialize_multiset, deserialize_labels
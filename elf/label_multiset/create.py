@@ -1,4 +1,7 @@
+from functools import reduce
 from math import ceil
+from operator import mul
+import numba
 import numpy as np
 import nifty.tools as nt
 from .label_multiset import LabelMultiset
@@ -8,22 +11,100 @@ from ..util import downscale_shape
 def create_multiset_from_labels(labels):
     """ Create label multiset from a regular label array.
 
+    Note that the argmax vector of the multiset is a view of `labels` if it is c-contiguous,
+    so `labels` should not be changed afterwards.
+
     Arguments:
         labels [np.ndarray] - label array to summarize.
     """
     # argmaxs per block = labels in our case
-    argmax = labels.flatten()
-
-    # ids and offsets
-    ids, offsets = np.unique(labels, return_inverse=True)
+    # (this only copies the labels if they are not c-contiguous)
+    argmax = np.ascontiguousarray(labels).ravel()
 
-    # counts (1 by definiition)
-    counts = np.ones(len(ids), dtype='int32')
+    # ids, offsets and counts (1 by definiition)
+    if labels.dtype.kind in 'ui':
+        # numba can only handle arrays in native byte order
+        ids, offsets, counts = _unique_inverse_int(argmax.astype(argmax.dtype.newbyteorder('='), copy=False))
+    else:
+        ids, offsets = np.unique(argmax, return_inverse=True)
+        counts = np.ones(len(ids), dtype='int32')
 
     multiset = LabelMultiset(argmax, offsets, ids, counts, labels.shape)
     return multiset
 
 
+# maximal size of the look-up table used to compute dense ids in _unique_inverse_int,
+# relative to the array size and absolute; for a larger value range we fall back to a hash map
+_LUT_SIZE_FACTOR = 4
+_MAX_LUT_SIZE = 2 ** 24
+
+
+@numba.njit(cache=True, nogil=True)
+def _unique_inverse_int(flat):
+    """ Compute the sorted unique values of a flat integer array, the inverse mapping
+    and the multiset counts for a label array, which are all 1.
+
+    Equivalent to `np.unique(flat, return_inverse=True)`, but avoids sorting the full array.
+    """
+    n = flat.shape[0]
+    offsets = np.empty(n, dtype=np.uint64)
+    if n == 0:
+        return flat[:0].copy(), offsets, np.ones(0, dtype=np.int32)
+
+    # find the value range; we compute it in uint64 to avoid overflows for signed types
+    min_val, max_val = flat[0], flat[0]
+    for i in range(n):
+        val = flat[i]
+        if val < min_val:
+            min_val = val
+        elif val > max_val:
+            max_val = val
+    umin = np.uint64(min_val)
+    value_range = np.uint64(max_val) - umin
+
+    # small value range: map values to dense ids with a look-up table
+    if value_range < _MAX_LUT_SIZE and value_range < np.uint64(_LUT_SIZE_FACTOR * n):
+        lut = np.zeros(int(value_range) + 1, dtype=np.int64)
+        for i in range(n):
+            lut[np.uint64(flat[i]) - umin] = 1
+        # the prefix sum over the occupied values yields the (sorted) dense ids
+        n_unique = 0
+        for i in range(lut.shape[0]):
+            if lut[i] > 0:
+                lut[i] = n_unique
+                n_unique += 1
+        ids = np.empty(n_unique, dtype=flat.dtype)
+        for i in range(n):
+            dense_id = lut[np.uint64(flat[i]) - umin]
+            offsets[i] = dense_id
+            ids[dense_id] = flat[i]
+        return ids, offsets, np.ones(n_unique, dtype=np.int32)
+
+    # large value range: map values to ids in order of appearance with a hash map
+    # and sort the unique values afterwards
+    mapping = numba.typed.Dict.empty(key_type=numba.types.uint64, value_type=numba.types.int64)
+    unsorted_ids = np.empty(n, dtype=flat.dtype)
+    n_unique = 0
+    for i in range(n):
+        key = np.uint64(flat[i])
+        dense_id = mapping.get(key, -1)
+        if dense_id == -1:
+            dense_id = n_unique
+            mapping[key] = dense_id
+            unsorted_ids[dense_id] = flat[i]
+            n_unique += 1
+        offsets[i] = dense_id
+
+    unsorted_ids = unsorted_ids[:n_unique]
+    order = np.argsort(unsorted_ids)
+    rank = np.empty(n_unique, dtype=np.uint64)
+    for i in range(n_unique):
+        rank[order[i]] = i
+    for i in range(n):
+        offsets[i] = rank[offsets[i]]
+    return unsorted_ids[order], offsets, np.ones(n_unique, dtype=np.int32)
+
+
 def downsample_multiset(multiset, scale_factor, restrict_set=-1):
     """ Downsample label multiset from other multiset.
 
@@ -45,6 +126,41 @@ def downsample_multiset(multiset, scale_factor, restrict_set=-1):
     return LabelMultiset(argmax, offsets, ids, counts, new_shape)
 
 
+@numba.njit(cache=True, nogil=True)
+def _linear_index(i, begin, end, shape_strides):
+    """ Compute the linear index in the full volume from the c-order index i in the block.
+    """
+    remainder, index = i, 0
+    for d in range(begin.shape[0] - 1, -1, -1):
+        extent = end[d] - begin[d]
+        index += (begin[d] + remainder % extent) * shape_strides[d]
+        remainder //= extent
+    return index
+
+
+# the block indices are always computed for the same types, so we compile them eagerly
+@numba.njit(['void(uint32[::1], int64[::1], int64[::1], int64[::1])',
+             'void(uint64[::1], int64[::1], int64[::1], int64[::1])'],
+            cache=True, nogil=True)
+def _block_indices(out, begin, end, shape_strides):
+    """ Write the linear indices of the block into out.
+    """
+    for i in range(out.shape[0]):
+        out[i] = _linear_index(i, begin, end, shape_strides)
+
+
+# this is called per block, so we don't use parallel=True; this also keeps it safe
+# to call from multiple python threads, which is not the case for the workqueue threading layer
+@numba.njit(cache=True, nogil=True)
+def _scatter_pair(argmax_out, offsets_out, indices, argmax_in, offsets_in):
+    """ Write argmax and offsets of a block into the flat argmax and offset vectors.
+    """
+    for i in range(indices.shape[0]):
+        index = indices[i]
+        argmax_out[index] = argmax_in[i]
+        offsets_out[index] = offsets_in[i]
+
+
 def merge_multisets(multisets, grid_positions, shape, chunks):
     """ Merge label multisets aranged in grid.
 
@@ -54,78 +170,145 @@ def merge_multisets(multisets, grid_positions, shape, chunks):
         shape [tuple] - shape of the resulting multiset / grid.
         chunks [tuple] - chunk shape = default shape of input multiset.
     """
-    if not isinstance(multisets, (tuple, list)) and\
-       not all(isinstance(ms, LabelMultiset) for ms in multisets):
-        raise ValueError("Expect list or tuple of LabelMultiset")
+    if not isinstance(multisets, (tuple, list)):
+        raise ValueError("Expect list or tuple of LabelMultiset, got %s" % type(multisets))
 
     # arrange multisets according to the grid
-    multisets, blocking = _compute_multiset_vector(multisets, grid_positions,
-                                                   shape, chunks)
+    multisets, block_coords = _compute_multiset_vector(multisets, grid_positions,
+                                                       shape, chunks)
+
+    new_size = int(reduce(mul, shape, 1))
+    # argmax keeps the dtype of the input multisets (in native byte order, so that numba can handle it),
+    # offsets are stored as uint64 by LabelMultiset anyways
+    argmax_dtype = np.result_type(*[ms.argmax.dtype for ms in multisets]).newbyteorder('=')
+    # mixing signed and unsigned 64 bit integers results in float, so we fall back to uint64
+    if argmax_dtype.kind not in 'ui':
+        argmax_dtype = np.dtype('uint64')
+    # we don't need to initialize argmax and offsets, because the blocks cover the full volume
+    # (this is checked in _compute_multiset_vector)
+    argmax = np.empty(new_size, dtype=argmax_dtype)
+    offsets = np.empty(new_size, dtype='uint64')
+    # use the narrowest dtype that can index the merged multiset for the block indices
+    index_dtype = np.dtype('uint32') if new_size <= 2 ** 32 else np.dtype('uint64')
 
-    new_size = int(np.prod(shape))
-    argmax = np.zeros(new_size, dtype='uint64')
-    offsets = np.zeros(new_size, dtype='uint64')
+    shape_strides = np.cumprod((tuple(shape) + (1,))[:0:-1])[::-1].astype('int64')
 
-    def get_indices(block_id):
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
-        new_indices = np.array([ax.flatten() for ax in np.mgrid[bb]])
-        new_indices = np.ravel_multi_index(new_indices, shape)
-        return new_indices
+    # the indices for blocks of full chunk shape only differ by an offset,
+    # so we compute them once and only compute them for the blocks at the border
+    chunks = tuple(chunks)
+    chunk_array = np.array(chunks, dtype='int64')
+    chunk_indices = np.empty(int(reduce(mul, chunks, 1)), dtype=index_dtype)
+    _block_indices(chunk_indices, np.zeros(len(chunks), dtype='int64'), chunk_array, shape_strides)
 
+    # the indices of each block are written to the same buffer
+    scratch = np.empty_like(chunk_indices)
+
+    def write_block(block_coord, block_argmax, block_offsets):
+        block_begin = np.array(block_coord, dtype='int64') * chunk_array
+        new_indices = scratch[:block_argmax.size]
+        if block_argmax.shape == chunks:
+            np.add(chunk_indices, index_dtype.type(block_begin.dot(shape_strides)), out=new_indices)
+        else:
+            block_end = block_begin + np.array(block_argmax.shape, dtype='int64')
+            _block_indices(new_indices, block_begin, block_end, shape_strides)
+        _scatter_pair(argmax, offsets, new_indices,
+                      block_argmax.ravel().astype(argmax_dtype, copy=False), block_offsets.ravel())
+
+    ids, counts = _merge_multisets(multisets, block_coords, write_block)
+    return LabelMultiset(argmax, offsets, ids, counts, shape)
+
+
+def merge_multisets_chunked(multisets, grid_positions, shape, chunks, writer):
+    """ Merge label multisets aranged in grid block by block, without
+    building the argmax and offset vectors of the merged multiset.
+
+    The function `writer` is called for each block with the grid coordinate
+    of the block and the block's argmax and offsets, which refer to the merged ids and counts.
+    This can be used to write merged multiset chunks to disc directly.
+
+    Arguments:
+        multisets [listlike[LabelMultiset]] - list of label multisets aranged in grid.
+        grid_positions [list] - list of grid coordinates of the input list.
+        shape [tuple] - shape of the resulting multiset / grid.
+        chunks [tuple] - chunk shape = default shape of input multiset.
+        writer [callable] - function that is called with
+            the grid coordinate, argmax and offsets of each block.
+    Returns:
+        np.ndarray - the ids of the merged multiset
+        np.ndarray - the counts of the merged multiset
+    """
+    if not isinstance(multisets, (tuple, list)):
+        raise ValueError("Expect list or tuple of LabelMultiset, got %s" % type(multisets))
+
+    # arrange multisets according to the grid
+    multisets, block_coords = _compute_multiset_vector(multisets, grid_positions,
+                                                       shape, chunks)
+    return _merge_multisets(multisets, block_coords, writer)
+
+
+def _merge_multisets(multisets, block_coords, writer):
     # create merge helper initialized with multisets[0]
     ms = multisets[0]
-    merge_helper = nt.MultisetMerger(np.unique(ms.offsets), ms.entry_sizes, ms.ids, ms.counts)
-    # map offsets and argmax for first multiset
-    new_indices = get_indices(0)
-    argmax[new_indices] = ms.argmax
-    offsets[new_indices] = ms.offsets
-
-    for block_id, ms in enumerate(multisets[1:], 1):
-        # map to the new indices
-        new_indices = get_indices(block_id)
-        # map argmax
-        argmax[new_indices] = ms.argmax
+    merge_helper = nt.MultisetMerger(ms.unique_offsets, ms.entry_sizes, ms.ids, ms.counts)
+    # write argmax and offsets for first multiset
+    writer(block_coords[0], ms.argmax.reshape(ms.shape), ms.offsets.reshape(ms.shape))
 
+    # the blocks need to be merged serially, because the merge helper is stateful
+    for block_coord, ms in zip(block_coords[1:], multisets[1:]):
         # update the merge helper
-        new_offsets = merge_helper.update(np.unique(ms.offsets), ms.entry_sizes,
+        new_offsets = merge_helper.update(ms.unique_offsets, ms.entry_sizes,
                                           ms.ids, ms.counts, ms.entry_offsets)
-        offsets[new_indices] = new_offsets
+        # write argmax and offsets
+        writer(block_coord, ms.argmax.reshape(ms.shape), new_offsets.reshape(ms.shape))
 
     ids = merge_helper.get_ids()
     counts = merge_helper.get_counts()
-    return LabelMultiset(argmax, offsets, ids, counts, shape)
+    return ids, counts
 
 
 def _compute_multiset_vector(multisets, grid_positions, shape, chunks):
-    """ Arange the multisets in c-order.
+    """ Arange the multisets in c-order and compute the corresponding grid coordinates.
     """
     n_sets = len(multisets)
     ndim = len(shape)
-    multiset_vector = n_sets * [None]
 
     blocking = nt.blocking(ndim * [0], shape, list(chunks))
     n_blocks = blocking.numberOfBlocks
     if n_blocks != n_sets:
         raise ValueError("Invalid grid: %i, %i" % (n_blocks, n_sets))
+    grid_shape = tuple(blocking.blocksPerAxis)
+
+    # compute the block geometry for all blocks (in c-order) at once
+    block_coords = np.stack(np.unravel_index(np.arange(n_blocks), grid_shape), axis=1)
+    block_begins = block_coords.astype('int64') * np.array(chunks, dtype='int64')
+    block_ends = np.minimum(block_begins + np.array(chunks, dtype='int64'), np.array(shape, dtype='int64'))
+    block_shapes = block_ends - block_begins
 
     # get the c-order positions
-    positions = np.array([[gp[i] for gp in grid_positions] for i in range(ndim)],
-                         dtype='int')
-    grid_shape = tuple(blocking.blocksPerAxis)
-    positions = np.ravel_multi_index(positions, grid_shape)
-    if any(pos >= n_sets for pos in positions):
+    grid_positions = np.asarray(grid_positions, dtype='int64')
+    if grid_positions.shape != (n_sets, ndim):
+        raise ValueError("Invalid grid positions")
+    if (grid_positions < 0).any() or (grid_positions >= np.array(grid_shape)).any():
         raise ValueError("Invalid grid positions")
+    positions = np.ravel_multi_index(grid_positions.T, grid_shape)
 
-    # put multi-sets into vector and check shapes
-    for pos in positions:
-        mset = multisets[pos]
-        block_shape = tuple(blocking.getBlock(pos).shape)
-        if mset.shape != block_shape:
-            raise ValueError("Invalid multiset shape: %s, %s" % (str(mset.shape),
-                                                                 str(block_shape)))
-        multiset_vector[pos] = mset
+    # check the multiset types and shapes
+    multiset_shapes = []
+    for mset in multisets:
+        if not isinstance(mset, LabelMultiset):
+            raise ValueError("Expect list or tuple of LabelMultiset, got element of type %s" % type(mset))
+        multiset_shapes.append(mset.shape)
+    multiset_shapes = np.array(multiset_shapes, dtype='int64')
+    invalid_shapes = (multiset_shapes != block_shapes[positions]).any(axis=1)
+    if invalid_shapes.any():
+        set_id = np.argmax(invalid_shapes)
+        block_shape = tuple(block_shapes[positions[set_id]].tolist())
+        raise ValueError("Invalid multiset shape: %s, %s" % (str(multisets[set_id].shape),
+                                                             str(block_shape)))
 
-    if any(ms is None for ms in multiset_vector):
+    # put multi-sets into vector
+    if len(np.unique(positions)) != n_sets:
         raise ValueError("Not all grid-positions filled")
-    return multiset_vector, blocking
+    multiset_vector = [multisets[set_id] for set_id in np.argsort(positions)]
+    block_coords = [tuple(coord) for coord in block_coords.tolist()]
+    return multiset_vector, block_coords
@@ -1,3 +1,5 @@
+from functools import reduce
+from operator import mul
 import numpy as np
 import nifty.tools as nt
 from ..util import normalize_index
@@ -23,14 +25,14 @@ class LabelMultiset:
 
     def __init__(self, argmax, offsets, ids, counts, shape):
         self._shape = tuple(shape)
-        self._size = int(np.prod(list(shape)))
+        self._size = int(reduce(mul, self._shape, 1))
 
         if len(argmax) != len(offsets) != self.size:
             raise ValueError("Shape, argmax and offset do not match: %i %i %i" % (len(argmax),
                                                                                   len(offsets),
                                                                                   self.size))
         self.argmax = argmax
-        self.offsets = offsets.astype('uint64')
+        self.offsets = offsets.astype('uint64', copy=False)
 
         if len(ids) != len(counts):
             raise ValueError("Ids and counts do not match: %i, %i" % (len(ids), len(counts)))
@@ -40,10 +42,12 @@ class LabelMultiset:
 
         # compute the unique-offsets (= corresponding to entries) and the offsets
         # w.r.t entries instead of elements
+        # we keep the unique offsets, because they are needed for merging and serialization
         unique_offsets, self.entry_offsets = np.unique(self.offsets, return_inverse=True)
         if unique_offsets[-1] >= self.n_elements:
             raise ValueError("Elements and offsets do not match: %i, %i" % (self.n_elements,
                                                                             unique_offsets[-1]))
+        self._unique_offsets = unique_offsets
         self.n_entries = len(unique_offsets)
         # compute size of the entries from unique offsets
         unique_offsets = np.concatenate([unique_offsets,
@@ -77,3 +81,7 @@ class LabelMultiset:
     @property
     def size(self):
         return self._size
+
+    @property
+    def unique_offsets(self):
+        return self._unique_offsets
@@ -2,6 +2,10 @@ import struct
 import numpy as np
 from .label_multiset import LabelMultiset
 
+# the serialization stores the ids (as long) and counts (as int) of the multiset elements interleaved,
+# so we pack them into an array of structs with the same memory layout
+ELEMENT_DTYPE = np.dtype([('id', '<q'), ('count', '<i')])
+
 
 def deserialize_labels(serialization, shape):
     """ Deserialize summarized label array from multiset serialization.
@@ -52,43 +56,31 @@ def deserialize_multiset(serialization, shape):
 
     # compute the unique byte offsets and the inverse mapping
     byte_offsets, inverse_offsets = np.unique(offsets, return_inverse=True)
+    byte_offsets = byte_offsets.astype('int64')
 
-    # the data is encoded as byte buffer,
-    # storing ids as longs and counts as ints
+    # the data is encoded as byte buffer, storing the number of elements of each entry
+    # as int followed by the ids and counts as longs and ints
     data = serialization[next_pos:]
     assert byte_offsets[-1] < len(data)
 
-    def deserialize_entry(entry):
-        n_elements, entry = entry[:4], entry[4:]
-        n_elements = struct.unpack('<i', n_elements)[0]
-        byte_len = len(entry)
-        assert byte_len % 12 == 0, str(byte_len)
-        assert n_elements == byte_len // 12
-
-        # extract the ids and counts
-        entry = entry.reshape((n_elements, 12))
-        ids = entry[:, :8].flatten()
-        ids = np.frombuffer(ids.tobytes(), dtype='<q')
-        counts = entry[:, 8:].flatten()
-        counts = np.frombuffer(counts.tobytes(), dtype='<i')
-        return ids, counts
-
-    data_offsets = np.concatenate([byte_offsets,
-                                   np.array([len(data)], dtype=byte_offsets.dtype)])
-    # TODO vectorize
-    ids, counts = [], []
-    entry_offsets = []
-    for beg, end in zip(data_offsets[:-1], data_offsets[1:]):
-        mids, mcounts = deserialize_entry(data[beg:end])
-        ids.extend(mids)
-        counts.extend(mcounts)
-        entry_offsets.append(len(mids))
-
-    ids = np.array(ids, dtype='uint64')
-    counts = np.array(counts, dtype='int32')
+    # read the number of elements per entry
+    size_positions = byte_offsets[:, None] + np.arange(4)
+    entry_sizes = data[size_positions].view('<i').ravel()
+
+    # the entries need to be contiguous
+    data_offsets = np.concatenate([byte_offsets, np.array([len(data)], dtype='int64')])
+    assert np.array_equal(byte_offsets + 4 + 12 * entry_sizes, data_offsets[1:])
+
+    # extract the ids and counts by dropping the entry sizes from the data
+    element_mask = np.ones(len(data), dtype='bool')
+    element_mask[:byte_offsets[0]] = False
+    element_mask[size_positions] = False
+    elements = data[element_mask].view(ELEMENT_DTYPE)
+    ids = elements['id'].astype('uint64')
+    counts = elements['count'].astype('int32')
 
     # compute the set offsets from bye offsets and entry offsets
-    entry_offsets = np.concatenate([np.array([0]), entry_offsets[:-1]])
+    entry_offsets = np.concatenate([np.array([0]), entry_sizes[:-1]])
     entry_offsets = np.cumsum(entry_offsets)
     assert len(entry_offsets) == len(data_offsets) - 1
     offsets = entry_offsets[inverse_offsets]
@@ -118,39 +110,36 @@ def serialize_multiset(multiset):
     # encode the argmax vector
     argmax = np.array(argmax, dtype='>q').tobytes()
 
-    # merge and encode ids and counts.
-    # the ids are stored as long, the counts as int (both little endian).
-    ids = [struct.pack('<q', i) for i in ids]
-    counts = [struct.pack('<i', c) for c in counts]
-    # get list of the unique offsets to delineate entries
-    offset_list = np.concatenate([np.unique(offsets), np.array([n_elements])]).astype('uint64')
-    assert offset_list[-2] < n_elements, "%i, %i" % (offset_list[-2], n_elements)
+    # get the unique offsets to delineate entries
+    unique_offsets = multiset.unique_offsets.astype('int64')
+    assert unique_offsets[-1] < n_elements, "%i, %i" % (unique_offsets[-1], n_elements)
+    first_offset = unique_offsets[0]
+    unique_offsets -= first_offset
 
-    # zip entry_sizesm ids and counts into one list.
+    # pack ids and counts into one array.
     # given ids and counts:
     # ids = [id1, id2, id3, ..., idN]
     # counts = [c1, c2, c3, ..., cN]
-    # where (1, 2), (3), ..., (N) form multiset entries,
-    # we want to obtain:
-    # data = [[id1, c1, id2, c2], [id3, c3] ..., [idN, cN]]
-    data = [[x for t in zip(ids[beg:end], counts[beg:end]) for x in t]
-            for beg, end in zip(offset_list[:-1], offset_list[1:])]
-
-    # encode the data. we also prepend the entry size encoded as int for java
-    entry_sizes = [struct.pack('<i', es) for es in multiset.entry_sizes]
-    data = [b''.join([es] + elem) for es, elem in zip(entry_sizes, data)]
-    assert len(data) == n_entries
+    # we obtain:
+    # elements = [(id1, c1), (id2, c2), (id3, c3), ..., (idN, cN)]
+    elements = np.empty(n_elements - first_offset, dtype=ELEMENT_DTYPE)
+    elements['id'] = ids[first_offset:]
+    elements['count'] = counts[first_offset:]
+
+    # encode the data, where we prepend the entry size encoded as int for java to each entry.
+    # given that (1, 2), (3), ..., (N) form multiset entries, we want to obtain:
+    # data = [[es1, id1, c1, id2, c2], [es2, id3, c3] ..., [esM, idN, cN]]
+    # all fields are 4 byte aligned, so we can insert the entry sizes as ints into the packed elements
+    entry_sizes = multiset.entry_sizes.astype('<i')
+    data = np.insert(elements.view('<i'), 3 * unique_offsets, entry_sizes)
+    data = data.tobytes()
 
     # comupute the byte offsets for each entry in data
-    data_offsets = np.cumsum([0] + [len(entry) for entry in data[:-1]])
+    data_offsets = 4 * np.arange(n_entries) + 12 * unique_offsets
     assert len(data_offsets) == n_entries
 
-    # encode the data
-    data = b''.join(data)
-
     # get the offsets in bytes and encode
-    offsets = [data_offsets[off] for off in multiset.entry_offsets]
-    offsets = np.array(offsets, dtype='>i').tobytes()
+    offsets = data_offsets[multiset.entry_offsets].astype('>i').tobytes()
 
     # encode the number of sets
     size = struct.pack('>i', size)
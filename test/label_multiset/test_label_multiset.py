@@ -54,6 +54,24 @@ class TestLabelMultiset(unittest.TestCase):
             self.assertTrue(np.array_equal(ids, ids_exp))
             self.assertTrue(np.array_equal(counts, counts_exp))
 
+    @unittest.skipUnless(nifty, "Need nifty")
+    def test_multiset_ids(self):
+        from elf.label_multiset import create_multiset_from_labels
+        shape = (16, 16, 16)
+        # check small and large label ranges, signed labels, big-endian labels
+        # and large labels in a narrow range
+        labels = [np.random.randint(0, 2000, size=shape, dtype='uint64'),
+                  np.random.randint(0, 2 ** 40, size=shape, dtype='uint64'),
+                  np.random.randint(-1000, 1000, size=shape, dtype='int32'),
+                  np.random.randint(0, 2 ** 40, size=shape, dtype='uint64').astype('>u8'),
+                  np.random.randint(16 * 10 ** 6, 16 * 10 ** 6 + 100, size=shape, dtype='uint64'),
+                  np.random.randint(10 ** 7, 10 ** 7 + 10 ** 5, size=shape, dtype='uint64')]
+        for x in labels:
+            multiset = create_multiset_from_labels(x)
+            ids_exp, offsets_exp = np.unique(x, return_inverse=True)
+            self.assertTrue(np.array_equal(multiset.ids, ids_exp))
+            self.assertTrue(np.array_equal(multiset.offsets, offsets_exp.ravel()))
+
     @unittest.skipUnless(nifty, "Need nifty")
     def test_multiset_ds(self):
         from elf.label_multiset import (create_multiset_from_labels,
@@ -99,6 +117,11 @@ class TestLabelMultiset(unittest.TestCase):
                     multisets.append(multiset)
                     grid_positions.append(grid_pos)
 
+        # the multisets don't need to be passed in grid order
+        perm = np.random.permutation(len(multisets))
+        multisets = [multisets[p] for p in perm]
+        grid_positions = [grid_positions[p] for p in perm]
+
         multiset = merge_multisets(multisets, grid_positions, shape, chunks)
         self.assertEqual(multiset.shape, shape)
 
@@ -115,6 +138,71 @@ class TestLabelMultiset(unittest.TestCase):
             self.assertTrue(np.array_equal(ids, ids_exp))
             self.assertTrue(np.array_equal(counts, counts_exp))
 
+    @unittest.skipUnless(nifty, "Need nifty")
+    def test_merge_multisets_mixed_dtypes(self):
+        from elf.label_multiset import (create_multiset_from_labels, merge_multisets,
+                                        serialize_multiset, deserialize_multiset)
+        shape = (32, 32)
+        chunks = (16, 32)
+        x = np.random.randint(0, 2000, size=shape, dtype='uint64')
+        # this id can't be represented exactly as float
+        x[0, 0] = 2 ** 53 + 1
+        # the deserialized multiset has a signed big-endian argmax
+        multisets = [create_multiset_from_labels(x[:16]),
+                     deserialize_multiset(serialize_multiset(create_multiset_from_labels(x[16:])),
+                                          (16, 32))]
+        multiset = merge_multisets(multisets, [(0, 0), (1, 0)], shape, chunks)
+        self.assertEqual(multiset.argmax.dtype, np.dtype('uint64'))
+        self.assertTrue(np.array_equal(multiset.argmax, x.ravel()))
+
+    @unittest.skipUnless(nifty, "Need nifty")
+    def test_merge_multisets_invalid(self):
+        from elf.label_multiset import create_multiset_from_labels, merge_multisets
+        shape = (32, 32)
+        chunks = (16, 32)
+        x = np.random.randint(0, 2000, size=shape, dtype='uint64')
+        multisets = [create_multiset_from_labels(x[:16]), create_multiset_from_labels(x[16:])]
+        grid_positions = [(0, 0), (1, 0)]
+        with self.assertRaises(ValueError):
+            merge_multisets(iter(multisets), grid_positions, shape, chunks)
+        with self.assertRaises(ValueError):
+            merge_multisets([multisets[0], x[16:]], grid_positions, shape, chunks)
+        with self.assertRaises(ValueError):
+            merge_multisets(multisets, grid_positions[:1], shape, chunks)
+
+    @unittest.skipUnless(nifty, "Need nifty")
+    def test_merge_multisets_chunked(self):
+        from elf.label_multiset import (create_multiset_from_labels, merge_multisets,
+                                        merge_multisets_chunked)
+        shape = (32, 32, 32)
+        chunks = (16, 16, 16)
+        x = np.random.randint(0, 2000, size=shape, dtype='uint64')
+
+        multisets = []
+        grid_positions = []
+        for grid_pos in np.ndindex(2, 2, 2):
+            slice_ = tuple(slice(p * ch, (p + 1) * ch)
+                           for p, ch in zip(grid_pos, chunks))
+            multisets.append(create_multiset_from_labels(x[slice_]))
+            grid_positions.append(grid_pos)
+
+        argmax = np.zeros(shape, dtype='uint64')
+        offsets = np.zeros(shape, dtype='uint64')
+
+        def writer(block_coord, block_argmax, block_offsets):
+            slice_ = tuple(slice(p * ch, (p + 1) * ch)
+                           for p, ch in zip(block_coord, chunks))
+            argmax[slice_] = block_argmax
+            offsets[slice_] = block_offsets
+
+        ids, counts = merge_multisets_chunked(multisets, grid_positions, shape, chunks, writer)
+        self.assertTrue(np.array_equal(argmax, x))
+
+        multiset_expected = merge_multisets(multisets, grid_positions, shape, chunks)
+        self.assertTrue(np.array_equal(offsets.ravel(), multiset_expected.offsets))
+        self.assertTrue(np.array_equal(ids, multiset_expected.ids))
+        self.assertTrue(np.array_equal(counts, multiset_expected.counts))
+
 
 if __name__ == '__main__':
     unittest.main()
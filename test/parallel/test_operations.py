@@ -9,11 +9,23 @@ except ImportError:
 
 @unittest.skipUnless(nifty, "Need nifty")
 class TestOperations(unittest.TestCase):
+    shape = 3 * (64,)
+    block_shape = 3 * (16,)
+
+    # generate the test data once and copy it in the individual tests
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(seed=0)
+        cls.x = rng.random(cls.shape)
+        cls.y = rng.random(cls.shape)
+        cls.y_scalar = rng.random()
+        cls.y_broadcast = rng.random((1,) + cls.shape[1:])
+        cls.mask = rng.random(cls.shape) > .5
+
     def _test_op_array(self, op, op_exp, inplace):
-        shape = 3 * (64,)
-        block_shape = 3 * (16,)
-        x = np.random.rand(*shape)
-        y = np.random.rand(*shape)
+        block_shape = self.block_shape
+        x = self.x.copy()
+        y = self.y.copy()
 
         exp = op_exp(x, y)
         if inplace:
@@ -28,10 +40,9 @@ class TestOperations(unittest.TestCase):
             self.assertTrue(np.allclose(x, x_cpy))
 
     def _test_op_scalar(self, op, op_exp, inplace):
-        shape = 3 * (64,)
-        block_shape = 3 * (16,)
-        x = np.random.rand(*shape)
-        y = np.random.rand()
+        block_shape = self.block_shape
+        x = self.x.copy()
+        y = self.y_scalar
 
         exp = op_exp(x, y)
         if inplace:
@@ -46,22 +57,19 @@ class TestOperations(unittest.TestCase):
             self.assertTrue(np.allclose(x, x_cpy))
 
     def _test_op_broadcast(self, op, op_exp):
-        shapex = 3 * (64,)
-        shapey = (1, 64, 64)
-        block_shape = 3 * (16,)
-        x = np.random.rand(*shapex)
-        y = np.random.rand(*shapey)
+        block_shape = self.block_shape
+        x = self.x.copy()
+        y = self.y_broadcast.copy()
 
         exp = op_exp(x, y)
         op(x, y, block_shape=block_shape)
         self.assertTrue(np.allclose(exp, x))
 
     def _test_op_masked(self, op, op_exp):
-        shape = 3 * (64,)
-        block_shape = 3 * (16,)
-        x = np.random.rand(*shape)
-        y = np.random.rand()
-        mask = np.random.rand(*shape) > .5
+        block_shape = self.block_shape
+        x = self.x.copy()
+        y = self.y_scalar
+        mask = self.mask
 
         exp = x.copy()
         exp[mask] = op_exp(x[mask], y)
@@ -69,13 +77,12 @@ class TestOperations(unittest.TestCase):
         self.assertTrue(np.allclose(exp, x))
 
     def _test_op_roi(self, op, op_exp):
-        shape = 3 * (64,)
-        block_shape = 3 * (16,)
+        block_shape = self.block_shape
 
         rois = [np.s_[:], np.s_[:32, 32:], np.s_[:47, :], np.s_[:, 13:], np.s_[2:31, 5:59]]
         for roi in rois:
-            x = np.random.rand(*shape)
-            y = np.random.rand()
+            x = self.x
+            y = self.y_scalar
 
             res = x.copy()
             op(res, y, block_shape=block_shape, roi=roi)